@@ -3,6 +3,7 @@ import torch
 from torch import nn
 import torch.nn.functional as F
 from torch.nn.utils.rnn import pad_sequence
+from torch.utils.checkpoint import checkpoint
 from entmax import entmax_bisect
 
 # nucleus
@@ -33,10 +34,11 @@ ENTMAX_ALPHA = 1.3
 entmax = entmax_bisect
 
 class AutoregressiveWrapper(nn.Module):
-    def __init__(self, net, ignore_index = -100, pad_value = 0):
+    def __init__(self, net, ignore_index = -100, pad_value = 0, logits_chunk_size = None):
         super().__init__()
         self.pad_value = pad_value
         self.ignore_index = ignore_index
+        self.logits_chunk_size = logits_chunk_size
 
         self.net = net
         self.max_seq_len = net.max_seq_len
@@ -101,6 +103,27 @@ class AutoregressiveWrapper(nn.Module):
             mask = mask[:, :-1]
             kwargs.update(mask = mask)
 
-        out = self.net(xi, **kwargs)
-        loss = F.cross_entropy(out.transpose(1, 2), xo, ignore_index = self.ignore_index)
-        return loss
+        if self.logits_chunk_size is None:
+            out = self.net(xi, **kwargs)
+            loss = F.cross_entropy(out.transpose(1, 2), xo, ignore_index = self.ignore_index)
+            return loss
+
+        # compute the loss over chunks of the sequence, recomputing the logits of each chunk on the backward pass
+        # so that the full (batch, seq, num_tokens) logits are never held in memory
+        # this requires the net to expose its embeddings and to_logits separately, as TransformerWrapper does
+
+        embeds = self.net(xi, return_embeddings = True, **kwargs)
+
+        loss = 0.
+        for embeds_chunk, labels_chunk in zip(embeds.split(self.logits_chunk_size, dim = 1), xo.split(self.logits_chunk_size, dim = 1)):
+            loss = loss + checkpoint(self.chunk_loss, embeds_chunk, labels_chunk, use_reentrant = False)
+
+        return loss / (xo != self.ignore_index).sum()
+
+    def chunk_loss(self, embeds, labels):
+        # the logits are computed outside the net's forward, so run them under its autocast dtype, if it has one
+        autocast_dtype = getattr(self.net, 'autocast_dtype', None)
+
+        with torch.autocast(device_type = embeds.device.type, dtype = autocast_dtype, enabled = autocast_dtype is not None):
+            logits = self.net.to_logits(embeds)
+            return F.cross_entropy(logits.transpose(1, 2), labels, ignore_index = self.ignore_index, reduction = 'sum')
@@ -2,7 +2,8 @@ import math
 import torch
 from torch import nn, einsum
 import torch.nn.functional as F
-from functools import partial
+from torch.utils.checkpoint import checkpoint
+from functools import partial, wraps
 from inspect import isfunction
 from collections import namedtuple
 
@@ -55,6 +56,23 @@ def equals(val):
 def max_neg_value(tensor):
     return -torch.finfo(tensor.dtype).max
 
+def autocast_forward(fn):
+    # run the forward of a wrapper in mixed precision, if it was given an autocast dtype
+    # the main output is cast back to float32, for the loss
+    @wraps(fn)
+    def inner(self, x, *args, **kwargs):
+        if not exists(self.autocast_dtype):
+            return fn(self, x, *args, **kwargs)
+
+        with torch.autocast(device_type = x.device.type, dtype = self.autocast_dtype):
+            out = fn(self, x, *args, **kwargs)
+
+        if isinstance(out, tuple):
+            return (out[0].float(), *out[1:])
+
+        return out.float()
+    return inner
+
 # keyword argument helpers
 
 def pick_and_pop(keys, d):
@@ -97,14 +115,14 @@ class AbsolutePositionalEmbedding(nn.Module):
     def __init__(self, dim, max_seq_len):
         super().__init__()
         self.emb = nn.Embedding(max_seq_len, dim)
+        self.register_buffer('pos', torch.arange(max_seq_len), persistent = False)
         self.init_()
 
     def init_(self):
         nn.init.normal_(self.emb.weight, std = 0.02)
 
     def forward(self, x):
-        n = torch.arange(x.shape[1], device = x.device)
-        return self.emb(n)[None, :, :]
+        return self.emb(self.pos[:x.shape[1]])[None, :, :]
 
 class FixedPositionalEmbedding(nn.Module):
     def __init__(self, dim):
@@ -126,6 +144,9 @@ class RelativePositionBias(nn.Module):
         self.max_distance = max_distance
         self.relative_attention_bias = nn.Embedding(num_buckets, heads)
 
+        # buckets only depend on the relative distances, so they are cached for the largest sequence lengths seen
+        self.register_buffer('rp_bucket', None, persistent = False)
+
     @staticmethod
     def _relative_position_bucket(relative_position, causal = True, num_buckets = 32, max_distance = 128):
         ret = 0
@@ -135,7 +156,7 @@ class RelativePositionBias(nn.Module):
             ret += (n < 0).long() * num_buckets
             n = torch.abs(n)
         else:
-            n = torch.max(n, torch.zeros_like(n))
+            n = n.clamp(min = 0)
 
         max_exact = num_buckets // 2
         is_small = n < max_exact
@@ -143,20 +164,30 @@ class RelativePositionBias(nn.Module):
         val_if_large = max_exact + (
             torch.log(n.float() / max_exact) / math.log(max_distance / max_exact) * (num_buckets - max_exact)
         ).long()
-        val_if_large = torch.min(val_if_large, torch.full_like(val_if_large, num_buckets - 1))
+        val_if_large.clamp_(max = num_buckets - 1)
 
         ret += torch.where(is_small, n, val_if_large)
         return ret
 
-    def forward(self, qk_dots):
-        i, j, device = *qk_dots.shape[-2:], qk_dots.device
+    def get_rp_bucket(self, i, j):
+        if exists(self.rp_bucket) and self.rp_bucket.shape[0] >= i and self.rp_bucket.shape[1] >= j:
+            return self.rp_bucket
+
+        if exists(self.rp_bucket):
+            i, j = max(i, self.rp_bucket.shape[0]), max(j, self.rp_bucket.shape[1])
+
+        device = self.relative_attention_bias.weight.device
         q_pos = torch.arange(i, dtype = torch.long, device = device)
         k_pos = torch.arange(j, dtype = torch.long, device = device)
         rel_pos = k_pos[None, :] - q_pos[:, None]
-        rp_bucket = self._relative_position_bucket(rel_pos, causal = self.causal, num_buckets = self.num_buckets, max_distance = self.max_distance)
+        self.rp_bucket = self._relative_position_bucket(rel_pos, causal = self.causal, num_buckets = self.num_buckets, max_distance = self.max_distance)
+        return self.rp_bucket
+
+    def forward(self, i, j):
+        rp_bucket = self.get_rp_bucket(i, j)[:i, :j]
         values = self.relative_attention_bias(rp_bucket)
         bias = rearrange(values, 'i j h -> () h i j')
-        return qk_dots + bias
+        return bias
 
 class RotaryEmbedding(nn.Module):
     def __init__(self, dim):
@@ -204,27 +235,32 @@ class Rezero(nn.Module):
 class ScaleNorm(nn.Module):
     def __init__(self, dim, eps = 1e-5):
         super().__init__()
-        self.scale = dim ** -0.5
         self.eps = eps
         self.g = nn.Parameter(torch.ones(1))
 
     def forward(self, x):
-        norm = torch.norm(x, dim = -1, keepdim = True) * self.scale
-        return x / norm.clamp(min = self.eps) * self.g
+        # same as dividing by the l2 norm times dim ** -0.5 clamped at eps, but written as a mean and rsqrt, which fuses
+        # the mean square is accumulated in float32, as squaring in half precision overflows for large activations
+        norm_sq = x.float().pow(2).mean(dim = -1, keepdim = True)
+        return x * torch.rsqrt(norm_sq.clamp(min = self.eps ** 2)).type_as(x) * self.g
 
 class RMSNorm(nn.Module):
     def __init__(self, dim, eps = 1e-8):
         super().__init__()
-        self.scale = dim ** -0.5
         self.eps = eps
         self.g = nn.Parameter(torch.ones(dim))
 
     def forward(self, x):
-        norm = torch.norm(x, dim = -1, keepdim = True) * self.scale
-        return x / norm.clamp(min = self.eps) * self.g
+        norm_sq = x.float().pow(2).mean(dim = -1, keepdim = True)
+        return x * torch.rsqrt(norm_sq.clamp(min = self.eps ** 2)).type_as(x) * self.g
 
 class Residual(nn.Module):
     def forward(self, x, residual):
+        # the branch output is freshly allocated, so it can be added to in place when no graph is being recorded
+        # but not when it is of lower precision than the residual, as under autocast, which would downcast the residual stream
+        if not torch.is_grad_enabled() and x.dtype == residual.dtype:
+            return x.add_(residual)
+
         return x + residual
 
 class GRUGating(nn.Module):
@@ -285,7 +321,9 @@ class Attention(nn.Module):
         use_entmax15 = False,
         num_mem_kv = 0,
         dropout = 0.,
-        on_attn = False
+        on_attn = False,
+        flash = False,
+        fuse_qkv = False
     ):
         super().__init__()
         self.scale = dim_head ** -0.5
@@ -293,11 +331,21 @@ class Attention(nn.Module):
         self.causal = causal
         self.mask = mask
 
+        # causal mask, cached for the largest key length seen
+        self.register_buffer('causal_mask', None, persistent = False)
+
         inner_dim = dim_head * heads
+        self.inner_dim = inner_dim
+
+        # self attention projects queries, keys and values with one matmul, cross attention projects keys and values with one
+
+        self.fuse_qkv = fuse_qkv
+        if fuse_qkv:
+            self.to_qkv = nn.Linear(dim, inner_dim * 3, bias = False)
+        else:
+            self.to_q = nn.Linear(dim, inner_dim, bias = False)
+            self.to_kv = nn.Linear(dim, inner_dim * 2, bias = False)
 
-        self.to_q = nn.Linear(dim, inner_dim, bias = False)
-        self.to_k = nn.Linear(dim, inner_dim, bias = False)
-        self.to_v = nn.Linear(dim, inner_dim, bias = False)
         self.dropout = nn.Dropout(dropout)
 
         # talking heads
@@ -318,17 +366,45 @@ class Attention(nn.Module):
             self.mem_k = nn.Parameter(torch.randn(heads, num_mem_kv, dim_head))
             self.mem_v = nn.Parameter(torch.randn(heads, num_mem_kv, dim_head))
 
+        # flash attention, via pytorch 2.0 scaled dot product attention
+        self.flash = flash
+        assert not (flash and not hasattr(F, 'scaled_dot_product_attention')), 'flash attention requires pytorch 2.0 or above'
+        assert not (flash and (talking_heads or exists(sparse_topk) or use_entmax15)), 'flash attention is not compatible with talking heads, sparse topk or entmax'
+
         # attention on attention
         self.attn_on_attn = on_attn
         self.to_out = nn.Sequential(nn.Linear(inner_dim, dim * 2), nn.GLU()) if on_attn else nn.Linear(inner_dim, dim)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # convert checkpoints with separate query, key and value projections
+
+        qkv_keys = [f'{prefix}to_{name}.weight' for name in ('q', 'k', 'v')]
+
+        if all(key in state_dict for key in qkv_keys):
+            q_weight, k_weight, v_weight = map(state_dict.pop, qkv_keys)
+
+            if self.fuse_qkv:
+                state_dict[f'{prefix}to_qkv.weight'] = torch.cat((q_weight, k_weight, v_weight))
+            else:
+                state_dict[f'{prefix}to_q.weight'] = q_weight
+                state_dict[f'{prefix}to_kv.weight'] = torch.cat((k_weight, v_weight))
+
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def get_causal_mask(self, i, j, device):
+        # queries are aligned to the last keys, which lets them attend to memories
+        if not exists(self.causal_mask) or self.causal_mask.shape[-1] < j:
+            self.causal_mask = torch.ones((j, j), device = device, dtype = torch.bool).triu(1)
+
+        return self.causal_mask[(j - i):j, :j]
+
     def forward(
         self,
         x,
         context = None,
         mask = None,
         context_mask = None,
-        rel_pos = None,
+        rel_pos_bias = None,
         sinusoidal_emb = None,
         rotary_pos_emb = None,
         prev_attn = None,
@@ -342,8 +418,8 @@ class Attention(nn.Module):
         v_input = kv_input
 
         if exists(mem):
-            k_input = torch.cat((mem, k_input), dim = -2)
-            v_input = torch.cat((mem, v_input), dim = -2)
+            # concatenated once, so keys and values share an input and are projected with one matmul
+            k_input = v_input = torch.cat((mem, kv_input), dim = -2)
 
         if exists(sinusoidal_emb):
             # in shortformer, the query would start at a position offset depending on the past cached memory
@@ -351,11 +427,21 @@ class Attention(nn.Module):
             q_input = q_input + sinusoidal_emb(q_input, offset = offset)
             k_input = k_input + sinusoidal_emb(k_input)
 
-        q = self.to_q(q_input)
-        k = self.to_k(k_input)
-        v = self.to_v(v_input)
+        # the fused projections are split into queries, keys, values and heads with a single view
 
-        q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> b h n d', h = h), (q, k, v))
+        if self.fuse_qkv and q_input is k_input and k_input is v_input:
+            q, k, v = rearrange(self.to_qkv(q_input), 'b n (qkv h d) -> qkv b h n d', qkv = 3, h = h)
+        else:
+            # inputs differ with memories or position infused attention, so project with slices of the weights
+            q_weight, kv_weight = self.to_qkv.weight.split((self.inner_dim, self.inner_dim * 2)) if self.fuse_qkv else (self.to_q.weight, self.to_kv.weight)
+            q = rearrange(F.linear(q_input, q_weight), 'b n (h d) -> b h n d', h = h)
+
+            if k_input is v_input:
+                k, v = rearrange(F.linear(k_input, kv_weight), 'b n (kv h d) -> kv b h n d', kv = 2, h = h)
+            else:
+                k_weight, v_weight = kv_weight.chunk(2)
+                k, v = F.linear(k_input, k_weight), F.linear(v_input, v_weight)
+                k, v = map(lambda t: rearrange(t, 'b n (h d) -> b h n d', h = h), (k, v))
 
         if exists(rotary_pos_emb):
             l = rotary_pos_emb.shape[-1]
@@ -364,23 +450,41 @@ class Attention(nn.Module):
             q = torch.cat((ql, qr), dim = -1)
             k = torch.cat((kl, kr), dim = -1)
 
-        input_mask = None
+        q_mask = k_mask = None
         if any(map(exists, (mask, context_mask))):
-            q_mask = default(mask, lambda: torch.ones((b, n), device = device).bool())
+            q_mask = default(mask, lambda: torch.ones((b, n), device = device, dtype = torch.bool))
             k_mask = q_mask if not exists(context) else context_mask
-            k_mask = default(k_mask, lambda: torch.ones((b, k.shape[-2]), device = device).bool())
+            k_mask = default(k_mask, lambda: torch.ones((b, k.shape[-2]), device = device, dtype = torch.bool))
             q_mask = rearrange(q_mask, 'b i -> b () i ()')
             k_mask = rearrange(k_mask, 'b j -> b () () j')
-            input_mask = q_mask * k_mask
 
         if self.num_mem_kv > 0:
             mem_k, mem_v = map(lambda t: repeat(t, 'h n d -> b h n d', b = b), (self.mem_k, self.mem_v))
             k = torch.cat((mem_k, k), dim = -2)
             v = torch.cat((mem_v, v), dim = -2)
-            if exists(input_mask):
-                input_mask = F.pad(input_mask, (self.num_mem_kv, 0), value = True)
 
-        dots = einsum('b h i d, b h j d -> b h i j', q, k) * self.scale
+        if self.flash:
+            if exists(k_mask) and self.num_mem_kv > 0:
+                k_mask = F.pad(k_mask, (self.num_mem_kv, 0), value = True)
+
+            attn_bias = rel_pos_bias[..., :q.shape[-2], :k.shape[-2]] if exists(rel_pos_bias) else None
+
+            # only mask the keys, as padded queries would otherwise attend to nothing and yield nans
+            out = self.flash_attn(q, k, v, mask = k_mask, attn_bias = attn_bias)
+
+            # flash kernels already lay out their output as (b, n, h, d), so merging the heads is a free view
+            out = out.transpose(1, 2).reshape(b, n, self.inner_dim)
+
+            intermediates = Intermediates(
+                pre_softmax_attn = None,
+                post_softmax_attn = None
+            )
+
+            return self.to_out(out), intermediates
+
+        # scale the queries rather than the much larger attention logits
+        q = q * self.scale
+        dots = torch.matmul(q, k.transpose(-1, -2))
         mask_value = max_neg_value(dots)
 
         if exists(prev_attn):
@@ -391,20 +495,23 @@ class Attention(nn.Module):
         if talking_heads:
             dots = einsum('b h i j, h k -> b k i j', dots, self.pre_softmax_proj).contiguous()
 
-        if exists(rel_pos):
-            dots = rel_pos(dots)
+        if exists(rel_pos_bias):
+            i, j = dots.shape[-2:]
+            dots = dots + rel_pos_bias[..., :i, :j]
+
+        if exists(k_mask):
+            input_mask = q_mask & k_mask
+
+            if self.num_mem_kv > 0:
+                # padded queries can still attend to the memory key / values
+                input_mask = F.pad(input_mask, (self.num_mem_kv, 0), value = True)
 
-        if exists(input_mask):
             dots.masked_fill_(~input_mask, mask_value)
             del input_mask
 
         if self.causal:
             i, j = dots.shape[-2:]
-            r = torch.arange(i, device = device)
-            mask = rearrange(r, 'i -> () () i ()') < rearrange(r, 'j -> () () () j')
-            mask = F.pad(mask, (j - i, 0), value = False)
-            dots.masked_fill_(mask, mask_value)
-            del mask
+            dots.masked_fill_(self.get_causal_mask(i, j, device), mask_value)
 
         if exists(self.sparse_topk) and self.sparse_topk < dots.shape[-1]:
             top, _ = dots.topk(self.sparse_topk, dim = -1)
@@ -421,8 +528,8 @@ class Attention(nn.Module):
         if talking_heads:
             attn = einsum('b h i j, h k -> b k i j', attn, self.post_softmax_proj).contiguous()
 
-        out = einsum('b h i j, b h j d -> b h i d', attn, v)
-        out = rearrange(out, 'b h n d -> b n (h d)')
+        out = torch.matmul(attn, v)
+        out = out.transpose(1, 2).reshape(b, n, self.inner_dim)
 
         intermediates = Intermediates(
             pre_softmax_attn = pre_softmax_attn,
@@ -431,6 +538,33 @@ class Attention(nn.Module):
 
         return self.to_out(out), intermediates
 
+    def flash_attn(self, q, k, v, mask = None, attn_bias = None):
+        i, j, device = q.shape[-2], k.shape[-2], q.device
+        causal = self.causal
+
+        # scaled dot product attention only aligns its causal mask to the top left, and cannot combine it with other masks
+        # so pass in the causal mask explicitly, aligned to the bottom right as in the non-flash path
+
+        if causal and (exists(mask) or exists(attn_bias) or i != j):
+            causal_mask = self.get_causal_mask(i, j, device)
+            mask = ~causal_mask if not exists(mask) else (mask & ~causal_mask)
+            causal = False
+
+        if exists(attn_bias):
+            attn_bias = attn_bias.type(q.dtype)
+
+            if exists(mask):
+                attn_bias = attn_bias.masked_fill(~mask, max_neg_value(attn_bias))
+
+            mask = attn_bias
+
+        return F.scaled_dot_product_attention(
+            q, k, v,
+            attn_mask = mask,
+            dropout_p = self.dropout.p if self.training else 0.,
+            is_causal = causal
+        )
+
 class AttentionLayers(nn.Module):
     def __init__(
         self,
@@ -457,6 +591,8 @@ class AttentionLayers(nn.Module):
         macaron = False,
         pre_norm = True,
         gate_residual = False,
+        use_checkpoint = False,
+        compile = False,
         **kwargs
     ):
         super().__init__()
@@ -465,6 +601,8 @@ class AttentionLayers(nn.Module):
 
         dim_head = attn_kwargs.get('dim_head', DEFAULT_DIM_HEAD)
 
+        assert not (attn_kwargs.get('flash', False) and (residual_attn or cross_residual_attn)), 'residual attention is not compatible with flash attention'
+
         self.dim = dim
         self.depth = depth
         self.layers = nn.ModuleList([])
@@ -477,12 +615,18 @@ class AttentionLayers(nn.Module):
 
         assert rel_pos_num_buckets <= rel_pos_max_distance, 'number of relative position buckets must be less than the relative position max distance'
         self.rel_pos = RelativePositionBias(causal = causal, heads = heads, num_buckets = rel_pos_num_buckets, max_distance = rel_pos_max_distance) if rel_pos_bias else None
+        self.num_mem_kv = attn_kwargs.get('num_mem_kv', 0)
+
+        # self attention fuses its query / key / value projections by default, unless turned off with attn_fuse_qkv = False
+        fuse_qkv = attn_kwargs.pop('fuse_qkv', True)
 
         self.pre_norm = pre_norm
 
         self.residual_attn = residual_attn
         self.cross_residual_attn = cross_residual_attn
 
+        self.use_checkpoint = use_checkpoint
+
         norm_class = ScaleNorm if use_scalenorm else nn.LayerNorm
         norm_class = RMSNorm if use_rmsnorm else norm_class
         norm_fn = partial(norm_class, dim)
@@ -524,7 +668,7 @@ class AttentionLayers(nn.Module):
 
         for layer_type in self.layer_types:
             if layer_type == 'a':
-                layer = Attention(dim, heads = heads, causal = causal, **attn_kwargs)
+                layer = Attention(dim, heads = heads, causal = causal, fuse_qkv = fuse_qkv, **attn_kwargs)
             elif layer_type == 'c':
                 layer = Attention(dim, heads = heads, **attn_kwargs)
             elif layer_type == 'f':
@@ -547,6 +691,12 @@ class AttentionLayers(nn.Module):
                 residual_fn
             ]))
 
+        # compile the whole stack of layers in place, so that with static shapes it is replayed as one cuda graph
+
+        if compile:
+            assert hasattr(nn.Module, 'compile'), 'compiling requires pytorch 2.2 or above'
+            self.compile(mode = 'reduce-overhead')
+
     def forward(
         self,
         x,
@@ -565,6 +715,14 @@ class AttentionLayers(nn.Module):
 
         rotary_pos_emb = self.rotary_pos_emb(x)
 
+        # the relative position bias only depends on distances, so it is computed once for the longest keys and sliced by each layer
+
+        rel_pos_bias = None
+        if exists(self.rel_pos):
+            n = x.shape[1]
+            max_mem_len = max([mem.shape[-2] for mem in mems if exists(mem)], default = 0)
+            rel_pos_bias = self.rel_pos(n, n + max_mem_len + self.num_mem_kv)
+
         for ind, (layer_type, (norm, block, residual_fn)) in enumerate(zip(self.layer_types, self.layers)):
             is_last = ind == (len(self.layers) - 1)
 
@@ -577,8 +735,13 @@ class AttentionLayers(nn.Module):
             if self.pre_norm:
                 x = norm(x)
 
+            # gradient checkpointing recomputes the activations of each block on the backward pass, to save memory
+
+            if self.training and self.use_checkpoint:
+                block = partial(checkpoint, block, use_reentrant = False)
+
             if layer_type == 'a':
-                out, inter = block(x, mask = mask, sinusoidal_emb = self.pia_pos_emb, rel_pos = self.rel_pos, rotary_pos_emb = rotary_pos_emb, prev_attn = prev_attn, mem = layer_mem)
+                out, inter = block(x, mask = mask, sinusoidal_emb = self.pia_pos_emb, rel_pos_bias = rel_pos_bias, rotary_pos_emb = rotary_pos_emb, prev_attn = prev_attn, mem = layer_mem)
             elif layer_type == 'c':
                 out, inter = block(x, context = context, mask = mask, context_mask = context_mask, prev_attn = prev_cross_attn)
             elif layer_type == 'f':
@@ -630,19 +793,21 @@ class ViTransformerWrapper(nn.Module):
         attn_layers,
         num_classes = None,
         dropout = 0.,
-        emb_dropout = 0.
+        emb_dropout = 0.,
+        autocast_dtype = None
     ):
         super().__init__()
         assert isinstance(attn_layers, Encoder), 'attention layers must be an Encoder'
         assert image_size % patch_size == 0, 'image dimensions must be divisible by the patch size'
         dim = attn_layers.dim
         num_patches = (image_size // patch_size) ** 2
-        patch_dim = 3 * patch_size ** 2
 
         self.patch_size = patch_size
 
+        # a strided convolution extracts and projects the patches in one pass over the image
+
         self.pos_embedding = nn.Parameter(torch.randn(1, num_patches + 1, dim))
-        self.patch_to_embedding = nn.Linear(patch_dim, dim)
+        self.patch_to_embedding = nn.Conv2d(3, dim, kernel_size = patch_size, stride = patch_size)
         self.cls_token = nn.Parameter(torch.randn(1, 1, dim))
         self.dropout = nn.Dropout(emb_dropout)
 
@@ -650,15 +815,27 @@ class ViTransformerWrapper(nn.Module):
         self.norm = nn.LayerNorm(dim)
         self.mlp_head = FeedForward(dim, dim_out = num_classes, dropout = dropout) if exists(num_classes) else None
 
+        self.autocast_dtype = autocast_dtype
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # convert checkpoints where the patches were projected with a linear layer
+
+        weight_key = f'{prefix}patch_to_embedding.weight'
+
+        if weight_key in state_dict and state_dict[weight_key].ndim == 2:
+            p = self.patch_size
+            state_dict[weight_key] = rearrange(state_dict[weight_key], 'd (p1 p2 c) -> d c p1 p2', p1 = p, p2 = p)
+
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    @autocast_forward
     def forward(
         self,
         img,
         return_embeddings = False
     ):
-        p = self.patch_size
-
-        x = rearrange(img, 'b c (h p1) (w p2) -> b (h w) (p1 p2 c)', p1 = p, p2 = p)
-        x = self.patch_to_embedding(x)
+        x = self.patch_to_embedding(img)
+        x = rearrange(x, 'b d h w -> b (h w) d')
         b, n, _ = x.shape
 
         cls_tokens = repeat(self.cls_token, '() n d -> b n d', b = b)
@@ -686,7 +863,8 @@ class TransformerWrapper(nn.Module):
         emb_dropout = 0.,
         num_memory_tokens = None,
         tie_embedding = False,
-        use_pos_emb = True
+        use_pos_emb = True,
+        autocast_dtype = None
     ):
         super().__init__()
         assert isinstance(attn_layers, AttentionLayers), 'attention layers must be one of Encoder or Decoder'
@@ -707,7 +885,7 @@ class TransformerWrapper(nn.Module):
 
         self.init_()
 
-        self.to_logits = nn.Linear(dim, num_tokens) if not tie_embedding else lambda t: t @ self.token_emb.weight.t()
+        self.to_logits = nn.Linear(dim, num_tokens) if not tie_embedding else lambda t: F.linear(t, self.token_emb.weight)
 
         # memory tokens (like [cls]) from Memory Transformers paper
         num_memory_tokens = default(num_memory_tokens, 0)
@@ -720,9 +898,12 @@ class TransformerWrapper(nn.Module):
             if hasattr(attn_layers, 'num_memory_tokens'):
                 attn_layers.num_memory_tokens = num_memory_tokens
 
+        self.autocast_dtype = autocast_dtype
+
     def init_(self):
         nn.init.normal_(self.token_emb.weight, std = 0.02)
 
+    @autocast_forward
     def forward(
         self,
         x,
@@ -777,7 +958,8 @@ class ContinuousTransformerWrapper(nn.Module):
         dim_out = None,
         emb_dim = None,
         emb_dropout = 0.,
-        use_pos_emb = True
+        use_pos_emb = True,
+        autocast_dtype = None
     ):
         super().__init__()
         assert isinstance(attn_layers, AttentionLayers), 'attention layers must be one of Encoder or Decoder'
@@ -796,6 +978,9 @@ class ContinuousTransformerWrapper(nn.Module):
 
         self.project_out = nn.Linear(dim, dim_out) if exists(dim_out) else nn.Identity()
 
+        self.autocast_dtype = autocast_dtype
+
+    @autocast_forward
     def forward(
         self,
         x,
@@ -828,6 +1013,7 @@ class XTransformer(nn.Module):
         *,
         dim,
         tie_token_emb = False,
+        compile = False,
         **kwargs
     ):
         super().__init__()
@@ -853,6 +1039,13 @@ class XTransformer(nn.Module):
         if tie_token_emb:
             self.decoder.token_emb = self.encoder.token_emb
 
+        # compile the encoder and decoder in place, so the state dict is unaffected
+
+        if compile:
+            assert hasattr(nn.Module, 'compile'), 'compiling requires pytorch 2.2 or above'
+            self.encoder.compile(mode = 'reduce-overhead', fullgraph = True)
+            self.decoder.compile(mode = 'reduce-overhead', fullgraph = True)
+
         self.decoder = AutoregressiveWrapper(self.decoder)
 
     @torch.no_grad()